@@ -13,9 +13,16 @@
 #     So for example, you'll have to change. 'list[RecordedFile]' to just 'list' for statically typed return types.
 
 
+import errno
+import operator
 import os
 import re
 import shutil
+import sys
+import time
+from collections import deque, namedtuple
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from humanize import naturalsize
@@ -29,6 +36,7 @@ archive_dir = upload_dir + os.sep + "RecordingArchives"  # Where the files are s
 min_unmodified_mins_before_archive = 5  # Only archive files that haven't been modified in this much time (prevent archiving files that are still being uploaded). Honestly it's probably ok to do a minute or less, but I just wanted to be safe.
 min_free_space_mb = 2048  # The amount of storage space (MB) at which a deletion will be triggered. If the free space goes below this value, then it will try to delete old files until the remaining storage space goes above this value plus the specified extra amount.
 extra_mb_to_delete = 1024  # After the delete threshold is reached, free this amount (MB) past the threshold. You can use this to free up extra space for the files before they are archived, since the deletion is run first.
+scan_threads = 4  # The number of archive folders to scan at the same time when looking for old files to delete. Scanning is mostly waiting on the storage (especially with SD cards), so doing a few at once is faster.
 # Debug settings; TODO: Change these to False after testing the script so it will actually work.
 verbose_logging = True
 simulate_delete_files = True
@@ -42,8 +50,11 @@ VIDEO_FILE_EXTENSION = '.mp4'
 device_name_regex_string = r'[a-zA-Z\d \-=+\[\]{}]+'  # These seem to be the only characters that Reolink allows for device names
 date_regex_string = r'([1-3]\d\d\d)([0-1]\d)([0-3]\d)([0-2]\d)([0-5]\d)([0-5]\d)'
 base_file_name_regex_string = f'({device_name_regex_string})_([\d]*)_?{date_regex_string}'
-photo_file_name_regex = re.compile(f'^{base_file_name_regex_string}{PHOTO_FILE_EXTENSION}$')
-video_file_name_regex = re.compile(f'^{base_file_name_regex_string}{VIDEO_FILE_EXTENSION}$')
+recorded_file_name_regex = re.compile(f'^{base_file_name_regex_string}({re.escape(PHOTO_FILE_EXTENSION)}|{re.escape(VIDEO_FILE_EXTENSION)})$', re.ASCII)  # Matches both photos and videos, with the file extension as the last group
+recorded_file_name_bytes_regex = re.compile(recorded_file_name_regex.pattern.encode('ascii'))  # The same, but for matching file names as bytes (bytes patterns only match ASCII anyway)
+OUTPUT_BUFFER_SIZE = 64 * 1024  # Buffer the output (it's flushed after each step), so verbose logging doesn't write every line separately
+# Used to create the archive directory for each file
+ARCHIVE_DATE_PATH_FORMAT = f'{os.sep}%Y{os.sep}%m{os.sep}%d{os.sep}'  # Format like '/2021/01/01/', using your OS path separator for the slash
 
 
 # Terminal colors/formatting
@@ -70,9 +81,10 @@ class RecordedFile(object):
     last_modified_ts = 0
     device_name = ""
     channel = None
-    datetime = None
+    sort_key = 0  # The date and time from the file name as a number (YYYYMMDDhhmmss), which sorts the same as the actual date and time
+    _datetime = None
 
-    def __init__(self, type: int, file_name: str, file_path: str, regex_match):
+    def __init__(self, type: int, file_name: str, file_path: str, regex_match, stat_result: os.stat_result = None):
         # Set recording type
         if type == self.TYPE_PHOTO or type == self.TYPE_VIDEO:
             self.type = type
@@ -83,34 +95,39 @@ class RecordedFile(object):
         self.name = file_name
         self.path = file_path
         
-        if not os.path.isfile(file_path):
-            self.error(f"'{file_path}' is not a valid file.")
-        else:
-            self.size = os.path.getsize(file_path)  # Set file size
-            self.last_modified_ts = os.path.getmtime(file_path)  # Set the file last modified value
+        # The caller already checked that it's a file, so we just need the stat result, which we usually already have (from os.scandir)
+        if stat_result is None:
+            try:
+                stat_result = os.stat(file_path)
+            except OSError as e:
+                self.error(f"Couldn't get the details of '{file_path}': {e}")
+        if stat_result is not None:
+            self.size = stat_result.st_size  # Set file size
+            self.last_modified_ts = stat_result.st_mtime  # Set the file last modified value
 
         if regex_match:
             # Get details from file name
-            groups = regex_match.groups()
-            self.device_name = groups[0]
-            self.channel_str = groups[1]
+            (device_name, channel_str, year, month, day, hour, minute, second) = regex_match.groups()[:8]  # Ignore the file extension group
+            self.device_name = device_name
+            self.channel_str = channel_str
             self.channel_num = None
-            if self.channel_str:
-                self.channel_num = int(self.channel_str) + 1  # Add 1 to the channel num so it matches what's shown in the Reolink client (which starts from 00)
-            # DateTime
-            year = groups[2]
-            month = groups[3]
-            day = groups[4]
-            hour = groups[5]
-            minute = groups[6]
-            second = groups[7]
-            self.datetime = datetime.fromisoformat(f'{year}-{month}-{day}T{hour}:{minute}:{second}')
+            if channel_str:
+                self.channel_num = int(channel_str) + 1  # Add 1 to the channel num so it matches what's shown in the Reolink client (which starts from 00)
+            # DateTime (only parsed when needed, see the datetime property)
+            self.sort_key = int(year + month + day + hour + minute + second)
         
         # self.print_debug()
     
+    @property
+    def datetime(self) -> datetime:
+        # Parse the date and time the first time it's used, since we don't need it for most files (like when sorting)
+        if self._datetime is None and self.sort_key:
+            key = str(self.sort_key)  # Always 14 digits, since the year can't start with 0
+            self._datetime = datetime.fromisoformat(f'{key[0:4]}-{key[4:6]}-{key[6:8]}T{key[8:10]}:{key[10:12]}:{key[12:14]}')
+        return self._datetime
+    
     def generate_archive_dir_string(self) -> str:
-        date_path_str = self.datetime.strftime("{0}%Y{0}%m{0}%d{0}".format(os.sep))  # Format like '/2021/01/01', using your OS path separator for the slash
-        return archive_dir + date_path_str
+        return archive_dir + self.datetime.strftime(ARCHIVE_DATE_PATH_FORMAT)
 
     def error(self, msg: str):
         print_red(f"Error while creating the RecordedFile object!\n\tReason: {msg}")
@@ -119,11 +136,22 @@ class RecordedFile(object):
         print(f"Type: {self.type}; Name: '{self.name}'; Path: '{self.path}'; Size: {self.size}; DeviceName: '{self.device_name}'; Channel: {self.channel_num} ('{self.channel_str}'); DateTime: {self.datetime}")
 
 
+# A lighter version of RecordedFile for archived files that might be deleted, since we only need the path and size (and the date from the file name to sort by)
+# The sort key is the date and time as a number (same as RecordedFile.sort_key), and the name and path are bytes (see get_archived_files)
+ArchivedFile = namedtuple('ArchivedFile', ['sort_key', 'name', 'path', 'size'])
+
+
 
 def main():
+    # Create the directories if they don't exist, so we don't have to check every time we use them
+    os.makedirs(upload_dir, exist_ok=True)
+    os.makedirs(archive_dir, exist_ok=True)
     delete_old_files_if_necessary()
+    sys.stdout.flush()
     archive_new_files()
+    sys.stdout.flush()
     delete_empty_sub_dirs(archive_dir)
+    sys.stdout.flush()
 
 
 
@@ -148,50 +176,59 @@ def check_bytes_to_free() -> int:
         return 0
 
 
-def get_all_old_files_to_delete(min_total_bytes: int) -> tuple[list[RecordedFile], int]:
+def get_all_old_files_to_delete(min_total_bytes: int) -> tuple[list[ArchivedFile], int]:
     print_blue("Checking for old files to delete...")
-    # Go through each folder in the archives, starting from the oldest files, until we have the correct amount to delete or there are no more files
-    all_files_to_delete: list[RecordedFile] = []
+    # Go through the files in the archives, starting from the oldest files, until we have the correct amount to delete or there are no more files
+    all_files_to_delete: list[ArchivedFile] = []
     total_size: int = 0
-    # Year folders
-    year_dirs = get_sub_dirs(archive_dir, full_paths=True, sort_alphabetically=True)
-    for year_dir in year_dirs:
+    archived_files = iter_archived_files_oldest_first(archive_dir)
+    for archived_file in archived_files:
         if total_size >= min_total_bytes:
             break
-        # Month folders
-        month_dirs = get_sub_dirs(year_dir, full_paths=True, sort_alphabetically=True)
-        for month_dir in month_dirs:
-            if total_size >= min_total_bytes:
-                break
-            # Day folders
-            day_dirs = get_sub_dirs(month_dir, full_paths=True, sort_alphabetically=True)
-            for day_dir in day_dirs:
-                if total_size >= min_total_bytes:
-                    break
-                # Get files to delete from current directory, and add to the total list and total size value
-                (this_dir_files, this_dir_total_size) = get_oldest_files_from_directory(day_dir, min_total_bytes - total_size)
-                all_files_to_delete.extend(this_dir_files)
-                total_size += this_dir_total_size
+        all_files_to_delete.append(archived_file)
+        total_size += archived_file.size
+    archived_files.close()  # Stop scanning the rest of the folders, since we already have enough files
         
     return (all_files_to_delete, total_size)
 
 
-def get_oldest_files_from_directory(directory: str, min_total_bytes: int) -> tuple[list[RecordedFile], int]:
-    # Load archived files in a single directory and get the oldest first up to the specified amount of bytes
-    oldest_files: list[RecordedFile] = []
-    total_size: int = 0
-    recorded_files: list[RecordedFile] = get_recorded_files(directory, oldest_first=True)
-    for recorded_file in recorded_files:
-        if total_size >= min_total_bytes:
-            break
-        else:
-            oldest_files.append(recorded_file)
-            total_size += recorded_file.size
-    
-    return (oldest_files, total_size)
-
-
-def delete_files(files_to_delete: list[RecordedFile], files_to_delete_total_size: int):
+def iter_archived_files_oldest_first(directory: str) -> Iterator[ArchivedFile]:
+    # Yield the archived files one day folder at a time, from oldest to newest, so we only scan as many folders as we need
+    with ThreadPoolExecutor(max_workers=scan_threads) as executor:
+        # Scan the next few day folders in the background while the current one is being used
+        scanning_day_dirs = deque()
+        try:
+            for day_dir in get_archive_day_dirs(directory):
+                scanning_day_dirs.append(executor.submit(get_archived_files, day_dir))
+                if len(scanning_day_dirs) > scan_threads:
+                    yield from scanning_day_dirs.popleft().result()
+            while scanning_day_dirs:
+                yield from scanning_day_dirs.popleft().result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)  # Don't scan the queued folders if we stop early (like when we already have enough files)
+
+
+def get_archive_day_dirs(directory: str) -> list[str]:
+    # Get the paths of all the day folders in the archive directory (like '/2021/01/01'), sorted from oldest to newest
+    day_dirs: list[tuple[tuple[int, int, int], str]] = []
+    for year_name in get_sub_dirs(directory, sort_alphabetically=False):
+        if not year_name.isdecimal():  # Using isdecimal (not isdigit), since int() works on every name it accepts
+            continue  # Not a year folder
+        year_dir = os.path.join(directory, year_name)
+        for month_name in get_sub_dirs(year_dir, sort_alphabetically=False):
+            if not month_name.isdecimal():
+                continue  # Not a month folder
+            month_dir = os.path.join(year_dir, month_name)
+            for day_name in get_sub_dirs(month_dir, sort_alphabetically=False):
+                if not day_name.isdecimal():
+                    continue  # Not a day folder
+                date_key = (int(year_name), int(month_name), int(day_name))
+                day_dirs.append((date_key, os.path.join(month_dir, day_name)))
+    day_dirs.sort()  # Sort by date
+    return [day_dir for _, day_dir in day_dirs]
+
+
+def delete_files(files_to_delete: list[ArchivedFile], files_to_delete_total_size: int):
     num_of_files_to_delete = len(files_to_delete)
     # Display info about files to delete
     if num_of_files_to_delete == 0:
@@ -203,20 +240,40 @@ def delete_files(files_to_delete: list[RecordedFile], files_to_delete_total_size
         deleted_files = 0
         deleted_total_size = 0
         failed_files = 0
-        for recorded_file in files_to_delete:
-            path = recorded_file.path
+        # Group the files by directory, so we only have to open each directory once and can delete the files relative to it
+        files_by_dir: dict[bytes, list[ArchivedFile]] = {}
+        for archived_file in files_to_delete:
+            files_by_dir.setdefault(os.path.dirname(archived_file.path), []).append(archived_file)
+        use_dir_fd = os.unlink in os.supports_dir_fd and hasattr(os, 'O_DIRECTORY')  # Not supported on Windows
+        for dir_path, dir_files in files_by_dir.items():
+            dir_fd = None
+            if use_dir_fd and not simulate_delete_files:
+                try:
+                    dir_fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY | getattr(os, 'O_CLOEXEC', 0))
+                except OSError as e:
+                    print_red(f"\tError opening directory '{os.fsdecode(dir_path)}'!\n\tReason: {e}")
+                    failed_files += len(dir_files)
+                    continue
             try:
-                if verbose_logging:
-                    print(f"\tDeleting '{path}'...")
-                if simulate_delete_files:
-                    print_yellow(f"\tSimulated delete file: '{path}'")
-                else:
-                    os.remove(path)
-                deleted_files += 1
-                deleted_total_size += recorded_file.size
-            except OSError as e:
-                print_red(f"\tError deleting '{path}'!\n\tReason: {e}")
-                failed_files += 1
+                for archived_file in dir_files:
+                    path = archived_file.path
+                    try:
+                        if verbose_logging:
+                            print(f"\tDeleting '{os.fsdecode(path)}'...")
+                        if simulate_delete_files:
+                            print_yellow(f"\tSimulated delete file: '{os.fsdecode(path)}'")
+                        elif dir_fd is not None:
+                            os.unlink(archived_file.name, dir_fd=dir_fd)
+                        else:
+                            os.remove(path)
+                        deleted_files += 1
+                        deleted_total_size += archived_file.size
+                    except OSError as e:
+                        print_red(f"\tError deleting '{os.fsdecode(path)}'!\n\tReason: {e}")
+                        failed_files += 1
+            finally:
+                if dir_fd is not None:
+                    os.close(dir_fd)
         
         # Print results
         if deleted_files > 0:
@@ -239,6 +296,7 @@ def archive_new_files():
         moved_files = 0
         moved_files_total_size = 0
         failed_files = 0
+        created_dirs: set[str] = set()  # The archive directories we already created (or that already existed), so we don't check them again for every file
         for recorded_file in new_files_to_archive:
             current_path = recorded_file.path
             new_path = recorded_file.generate_archive_dir_string()
@@ -248,9 +306,15 @@ def archive_new_files():
                 if simulate_move_files:
                     print_yellow(f"\tSimulated move file: '{current_path}' to '{new_path}'...")
                 else:
-                    if not os.path.exists(new_path):
-                        os.makedirs(new_path)
-                    shutil.move(current_path, new_path)
+                    if new_path not in created_dirs:
+                        os.makedirs(new_path, exist_ok=True)
+                        created_dirs.add(new_path)
+                    try:
+                        os.replace(current_path, os.path.join(new_path, recorded_file.name))  # Just a rename, since the archive is usually on the same file system
+                    except OSError as e:
+                        if e.errno != errno.EXDEV:
+                            raise
+                        shutil.move(current_path, new_path)  # The archive is on a different file system, so it has to be copied
                 moved_files += 1
                 moved_files_total_size += recorded_file.size
             except OSError as e:
@@ -267,75 +331,91 @@ def archive_new_files():
 
 def get_recorded_files(directory: str, min_mod_age: int = 0, include_video: bool = True, include_photo: bool = True, oldest_first: bool = True) -> list[RecordedFile]:
     try:
-        # Create the directory if it doesn't exist
-        if not os.path.exists(directory):
-            os.makedirs(directory)
         # Get all the recorded files
         recorded_files: list[RecordedFile] = []
-        dir_list = os.listdir(directory)  # Get the files and folders in the directory
-        for file_name in dir_list:
-            file_path = os.path.join(directory, file_name)
-            if os.path.isfile(file_path):  # Only list files
-                if include_photo:
-                    # Check if file name matches photo name regex
-                    photo_match = photo_file_name_regex.match(file_name)
-                    if photo_match:
-                        # Create RecordedFile object and add to list if it matches the last modification time requirement
-                        recorded_photo = RecordedFile(RecordedFile.TYPE_PHOTO, file_name, file_path, photo_match)
-                        if has_recorded_file_been_unmodified_for_(recorded_photo, min_mod_age):
-                            recorded_files.append(recorded_photo)
-                        continue  # Since it's a photo, skip checking if it's a video
-                if include_video:
-                    # Check if file name matches video name regex
-                    video_match = video_file_name_regex.match(file_name)
-                    if video_match:
-                        # Create RecordedFile object and add to list if it matches the last modification time requirement
-                        recorded_video = RecordedFile(RecordedFile.TYPE_VIDEO, file_name, file_path, video_match)
-                        if has_recorded_file_been_unmodified_for_(recorded_video, min_mod_age):
-                            recorded_files.append(recorded_video)
-                        continue  # Not really necessary, since it's the last one
+        # Get the file extensions to include, and the recording type for each
+        file_extension_types = {}
+        if include_photo:
+            file_extension_types[PHOTO_FILE_EXTENSION] = RecordedFile.TYPE_PHOTO
+        if include_video:
+            file_extension_types[VIDEO_FILE_EXTENSION] = RecordedFile.TYPE_VIDEO
+        match_file_name = recorded_file_name_regex.match  # Local reference, so we don't look it up for every file
+        now_ts = time.time()  # Get the current time once, instead of for every file
+        with os.scandir(directory) as dir_entries:  # Get the files and folders in the directory
+            for dir_entry in dir_entries:
+                if dir_entry.is_file(follow_symlinks=False):  # Only list files
+                    file_name = dir_entry.name
+                    # Check if file name matches the recorded file name regex (photo or video)
+                    file_match = match_file_name(file_name)
+                    if file_match:
+                        file_type = file_extension_types.get(file_match.group(file_match.lastindex))  # The last group is the file extension
+                        if file_type:
+                            # Check the last modification time requirement before creating the RecordedFile object, so we don't create objects for files we skip
+                            stat_result = dir_entry.stat()
+                            if now_ts > (stat_result.st_mtime + min_mod_age):
+                                # Create RecordedFile object and add to list
+                                recorded_files.append(RecordedFile(file_type, file_name, dir_entry.path, file_match, stat_result))
         
-        recorded_files.sort(key=lambda recorded_file: recorded_file.datetime.timestamp(), reverse=not oldest_first)  # Sort by time
+        recorded_files.sort(key=operator.attrgetter('sort_key'), reverse=not oldest_first)  # Sort by time
         return recorded_files
     except OSError as e:
         print_red(f"Error while getting recorded files in '{directory}'!\n\tReason: {e}")
         return []
 
 
-def has_recorded_file_been_unmodified_for_(recorded_file: RecordedFile, seconds: int) -> bool:
-    return datetime.now().timestamp() > (recorded_file.last_modified_ts + seconds)
+
+def get_archived_files(directory: str) -> list[ArchivedFile]:
+    # Like get_recorded_files, but only gets what we need to delete the files (sorted oldest first), without creating RecordedFile objects
+    # The directory is scanned as bytes, so the file names don't have to be decoded (and encoded again to delete them)
+    try:
+        archived_files: list[ArchivedFile] = []
+        match_file_name = recorded_file_name_bytes_regex.match  # Local reference, so we don't look it up for every file
+        with os.scandir(os.fsencode(directory)) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.is_file(follow_symlinks=False):  # Only list files
+                    file_name = dir_entry.name
+                    file_match = match_file_name(file_name)
+                    if file_match:
+                        sort_key = int(b''.join(file_match.group(3, 4, 5, 6, 7, 8)))  # The date and time from the file name, same as RecordedFile.sort_key
+                        archived_files.append(ArchivedFile(sort_key, file_name, dir_entry.path, dir_entry.stat().st_size))
+        
+        archived_files.sort()  # Sort by time (the sort key is first)
+        return archived_files
+    except OSError as e:
+        print_red(f"Error while getting archived files in '{directory}'!\n\tReason: {e}")
+        return []
 
 
 
 def get_sub_dirs(directory: str, full_paths: bool = False, sort_alphabetically: bool = True) -> list[str]:
     sub_dirs = []
     if os.path.exists(directory):
-        # Load sub directories and sort alphabetically if required
-        listed_sub_dirs = os.listdir(directory)
+        # Load sub directories
+        with os.scandir(directory) as dir_entries:
+            sub_dir_entries = [dir_entry for dir_entry in dir_entries if dir_entry.is_dir(follow_symlinks=False)]
+        # Sort alphabetically if required
         if sort_alphabetically:
-            listed_sub_dirs.sort()
+            sub_dir_entries.sort(key=lambda dir_entry: dir_entry.name)
         # Go through sub directories
-        for sub_dir_name in listed_sub_dirs:
-            sub_dir_path = os.path.join(directory, sub_dir_name)
-            if os.path.isdir(sub_dir_path):
-                if full_paths:
-                    sub_dirs.append(sub_dir_path)
-                else:
-                    sub_dirs.append(sub_dir_name)
+        for sub_dir_entry in sub_dir_entries:
+            if full_paths:
+                sub_dirs.append(sub_dir_entry.path)
+            else:
+                sub_dirs.append(sub_dir_entry.name)
     return sub_dirs
 
 
 def delete_empty_sub_dirs(directory: str):
     print_blue(f"Checking for and removing empty subfolders in '{directory}'...")
     dirs_deleted = 0
-    walk = list(os.walk(directory))
-    for path, _, _ in walk[::-1]:
-        if len(os.listdir(path)) == 0:  # If the directory is empty
+    deleted_dirs: set[str] = set()  # So we know a directory is empty if all of its sub directories were deleted
+    for path, dir_names, file_names in os.walk(directory, topdown=False):  # Bottom up, so sub directories are checked before their parents
+        if not file_names and all(os.path.join(path, dir_name) in deleted_dirs for dir_name in dir_names):  # If the directory is empty
             # Don't delete if it's the root directory
             if path == directory:
                 if verbose_logging:
                     print("\tSkipping root folder, even though it was empty.")
-                    continue
+                continue
             # Delete the directory
             try:
                 if verbose_logging:
@@ -344,6 +424,7 @@ def delete_empty_sub_dirs(directory: str):
                     print_yellow(f"\tSimulated delete directory: '{path}'")
                 else:
                     os.rmdir(path)
+                deleted_dirs.add(path)
                 dirs_deleted += 1
             except OSError as e:
                 print_red(f"\tError removing empty directory '{path}'!\n\tReason: {e}")
@@ -354,8 +435,6 @@ def delete_empty_sub_dirs(directory: str):
 
 
 def get_free_bytes(directory: str) -> int:
-    if not os.path.exists(directory):
-        os.makedirs(directory)
     return shutil.disk_usage(directory).free
 
 
@@ -395,6 +474,7 @@ def print_purple(msg: str):
 
 
 if __name__ == "__main__":
+    sys.stdout = open(sys.stdout.fileno(), 'w', buffering=OUTPUT_BUFFER_SIZE, encoding=sys.stdout.encoding, errors=sys.stdout.errors, closefd=False)  # Use a bigger buffer, which also isn't flushed on every line when running in a terminal
     start_time = datetime.now()
     print_purple(f"[{start_time}] - Script started")
     try:
@@ -403,5 +483,6 @@ if __name__ == "__main__":
         print_purple(f"[{end_time}] - Script finished (took {precisedelta(end_time - start_time, minimum_unit='milliseconds')})\n")
     except Exception as e:
         print(bcolors.RED + f"[{datetime.now()}] - Script terminated with an error: '{e}'")
+        sys.stdout.flush()  # Make sure everything is printed before the error
         raise e
 